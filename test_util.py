@@ -0,0 +1,152 @@
+import dask
+import netCDF4
+import numpy as np
+import pytest
+import xarray as xr
+
+import util
+
+
+@pytest.fixture
+def block_grid_files(tmp_path):
+    """grid and weight files averaging 2 x 2 blocks of an 8 x 6 grid onto
+    a 4 x 3 grid"""
+    nx_src, ny_src, nx_dst, ny_dst = 8, 6, 4, 3
+    src_grid_file = str(tmp_path / 'src.nc')
+    dst_grid_file = str(tmp_path / 'dst.nc')
+    weight_file = str(tmp_path / 'weights.nc')
+
+    util.latlon_to_scrip(nx_src, ny_src, file_out=src_grid_file)
+    grid_imask = np.ones((ny_dst, nx_dst), dtype=np.int32)
+    grid_imask[0, 0] = 0
+    util.latlon_to_scrip(nx_dst, ny_dst, grid_imask=grid_imask,
+                         file_out=dst_grid_file)
+
+    # 1-based indices, as in ESMF weight files
+    j, i, dj, di = np.meshgrid(np.arange(ny_dst), np.arange(nx_dst),
+                               np.arange(2), np.arange(2), indexing='ij')
+    row = (j * nx_dst + i).ravel() + 1
+    col = ((2 * j + dj) * nx_src + 2 * i + di).ravel() + 1
+    with netCDF4.Dataset(weight_file, 'w') as nc:
+        nc.createDimension('n_s', row.size)
+        nc.createVariable('row', 'i4', ('n_s',))[:] = row
+        nc.createVariable('col', 'i4', ('n_s',))[:] = col
+        nc.createVariable('S', 'f8', ('n_s',))[:] = np.full(row.size, 0.25)
+
+    return src_grid_file, dst_grid_file, weight_file
+
+
+@pytest.fixture
+def block_regridder(block_grid_files):
+    return util.regridder(*block_grid_files)
+
+
+def test_regrid_dataarray_dask_matches_numpy(block_regridder):
+    data = np.random.default_rng(0).random((5, 6, 8))
+    data[0, 0, 0] = np.nan
+    da_in = xr.DataArray(
+        data, dims=('time', 'lat', 'lon'), name='x', attrs={'units': 'm'},
+        coords={'time': np.arange(5), 'month': ('time', np.arange(5) + 1),
+                's': 1.0},
+    )
+
+    da_numpy = block_regridder.regrid_dataarray(da_in)
+    da_dask = block_regridder.regrid_dataarray(da_in.chunk({'time': 2}))
+
+    assert da_dask.chunks is not None
+    xr.testing.assert_identical(da_numpy, da_dask.compute())
+
+
+def test_regrid_dataarray_applies_mask(block_regridder):
+    da_in = xr.DataArray(np.ones((6, 8)), dims=('lat', 'lon'))
+    da_out = block_regridder.regrid_dataarray(da_in)
+
+    assert block_regridder.mask_dst.shape == (4, 3)
+    np.testing.assert_array_equal(da_out.isnull(), ~block_regridder.mask_dst_bool)
+    np.testing.assert_array_equal(da_out.isnull(), block_regridder.mask_dst.T == 0)
+
+
+def test_regrid_dataarray_numba_backend(block_grid_files):
+    pytest.importorskip('numba')
+    regrid_scipy = util.regridder(*block_grid_files)
+    regrid_numba = util.regridder(*block_grid_files, backend='numba')
+
+    data = np.random.default_rng(0).random((4, 6, 8))
+    data[0, 0, 0] = np.nan
+    da_in = xr.DataArray(data, dims=('time', 'lat', 'lon'), name='x')
+    expected = regrid_scipy.regrid_dataarray(da_in)
+
+    # single-level chunks are regridded concurrently in dask's worker
+    # threads (more than one, independent of the number of cores); this
+    # runs first so that the kernel has not been launched before
+    da_dask = regrid_numba.regrid_dataarray(da_in.chunk({'time': 1}))
+    with dask.config.set(scheduler='threads', num_workers=4):
+        xr.testing.assert_allclose(da_dask.compute(), expected)
+
+    # single-level numpy input uses the Numba kernel
+    for t in range(4):
+        xr.testing.assert_allclose(
+            regrid_numba.regrid_dataarray(da_in[t]), expected[t]
+        )
+
+
+# no missing values; one missing value; a fully missing 2 x 2 source block
+@pytest.mark.parametrize('nan_points', [
+    [], [(0, 0, 0)], [(1, 0, 0), (1, 0, 1), (1, 1, 0), (1, 1, 1)],
+])
+def test_regrid_dataarray_renormalize(block_regridder, monkeypatch, nan_points):
+    data = np.random.default_rng(0).random((3, 6, 8))
+    for p in nan_points:
+        data[p] = np.nan
+    da_in = xr.DataArray(data, dims=('time', 'lat', 'lon'))
+
+    # direct renormalization with two products
+    weights = block_regridder.weights.toarray()
+    data_flat = data.reshape(3, -1)
+    data_dst = np.nan_to_num(data_flat, nan=0.0) @ weights.T
+    ones_dst = (~np.isnan(data_flat)).astype(float) @ weights.T
+    with np.errstate(invalid='ignore'):
+        expected = np.where(ones_dst > 0.0, data_dst / ones_dst, np.nan)
+
+    calls = []
+    esmf_apply_weights = util.esmf_apply_weights
+
+    def counting_esmf_apply_weights(*args, **kwargs):
+        calls.append(args)
+        return esmf_apply_weights(*args, **kwargs)
+
+    monkeypatch.setattr(util, 'esmf_apply_weights', counting_esmf_apply_weights)
+    da_out = block_regridder.regrid_dataarray(da_in, apply_mask=False)
+
+    # without missing values, the cached row sums replace the second product
+    assert len(calls) == (2 if nan_points else 1)
+    np.testing.assert_allclose(da_out.values.reshape(3, -1), expected)
+
+
+@pytest.mark.parametrize('nx, ny, lon0', [(8, 6, -180.), (360, 180, 0.), (1440, 720, -180.)])
+def test_latlon_to_scrip_geometry(nx, ny, lon0):
+    dso = util.latlon_to_scrip(nx, ny, lon0=lon0, check_area=True)
+
+    # reference: stack the four corners of each cell (counterclockwise)
+    dx = 360. / nx
+    dy = 180. / ny
+    lat = np.arange(-90. + dy / 2., 90., dy)
+    lon = np.arange(lon0 + dx / 2., lon0 + 360., dx)
+    y_center = np.broadcast_to(lat[:, None], (ny, nx))
+    x_center = np.broadcast_to(lon[None, :], (ny, nx))
+    y_corner = np.stack((y_center - dy / 2., y_center - dy / 2.,
+                         y_center + dy / 2., y_center + dy / 2.), axis=2)
+    x_corner = np.stack((x_center - dx / 2., x_center + dx / 2.,
+                         x_center + dx / 2., x_center - dx / 2.), axis=2)
+    y0 = np.sin(y_corner[:, :, 0] * np.pi / 180.)
+    y1 = np.sin(y_corner[:, :, 3] * np.pi / 180.)
+    x0 = x_corner[:, :, 0] * np.pi / 180.
+    x1 = x_corner[:, :, 1] * np.pi / 180.
+    grid_area = (y1 - y0) * (x1 - x0)
+
+    np.testing.assert_array_equal(dso.grid_center_lat, y_center.ravel())
+    np.testing.assert_array_equal(dso.grid_center_lon, x_center.ravel())
+    np.testing.assert_array_equal(dso.grid_corner_lat, y_corner.reshape((-1, 4)))
+    np.testing.assert_array_equal(dso.grid_corner_lon, x_corner.reshape((-1, 4)))
+    np.testing.assert_allclose(dso.grid_area, grid_area.ravel(), rtol=0, atol=1e-14)
+    np.testing.assert_allclose(dso.grid_area.sum(), 4. * np.pi)
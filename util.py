@@ -1,12 +1,56 @@
 import os
 from datetime import datetime
 
+import netCDF4
 import scipy.sparse as sps
 import numpy as np
 import xarray as xr
 
+try:
+    import sparse_dot_mkl
+except ImportError:
+    sparse_dot_mkl = None
 
-def latlon_to_scrip(nx, ny, lon0=-180., grid_imask=None, file_out=None):
+# minimum number of extra-dimension levels for which the threaded MKL
+# sparse x dense kernel is used instead of scipy
+MKL_MIN_LEVELS = 8
+
+
+_numba_csr_matvec_kernel = None
+
+
+def _numba_csr_matvec():
+    """Return the Numba CSR matrix-vector kernel, building it on first use
+    so that numba is only imported for backend='numba'."""
+    global _numba_csr_matvec_kernel
+    if _numba_csr_matvec_kernel is None:
+        import numba
+
+        @numba.njit(parallel=True, cache=True)
+        def csr_matvec(indptr, indices, data, x, out):
+            """CSR matrix-vector product ``out = A @ x``, parallel over rows."""
+            for i in numba.prange(out.shape[0]):
+                acc = 0.
+                for jj in range(indptr[i], indptr[i + 1]):
+                    acc += data[jj] * x[indices[jj]]
+                out[i] = acc
+
+        _numba_csr_matvec_kernel = csr_matvec
+    return _numba_csr_matvec_kernel
+
+
+def _scrip_dataarray(data, dims, attrs=None, dtype=None):
+    """Construct a SCRIP grid variable with no '_FillValue' and,
+    optionally, the on-disk dtype set in its encoding."""
+    da = xr.DataArray(data, dims=dims, attrs=attrs or {})
+    da.encoding = {'_FillValue': None}
+    if dtype is not None:
+        da.encoding['dtype'] = dtype
+    return da
+
+
+def latlon_to_scrip(nx, ny, lon0=-180., grid_imask=None, file_out=None,
+                    check_area=False):
     """Generate a SCRIP grid file for a regular lat x lon grid.
     
     Parameters
@@ -24,6 +68,8 @@ def latlon_to_scrip(nx, ny, lon0=-180., grid_imask=None, file_out=None):
        generated by the application. 
     file_out : string, optional [default=None]
        File to which to write the grid.
+    check_area : boolean, optional [default=False]
+       If True, verify that the grid area sums to the area of the sphere.
 
     Returns
     -------
@@ -42,68 +88,68 @@ def latlon_to_scrip(nx, ny, lon0=-180., grid_imask=None, file_out=None):
     y_center = np.broadcast_to(lat[:, None], (ny, nx))
     x_center = np.broadcast_to(lon[None, :], (ny, nx))
 
+    # grid cell edges
+    lat_s = lat - dy / 2.
+    lat_n = lat + dy / 2.
+    lon_w = lon - dx / 2.
+    lon_e = lon + dx / 2.
+
     # compute corner points: must be counterclockwise
-    y_corner = np.stack((y_center - dy / 2.,  # SW
-                         y_center - dy / 2.,  # SE
-                         y_center + dy / 2.,  # NE
-                         y_center + dy / 2.), # NW
-                        axis=2)
-
-    x_corner = np.stack((x_center - dx / 2.,  # SW
-                         x_center + dx / 2.,  # SE
-                         x_center + dx / 2.,  # NE
-                         x_center - dx / 2.), # NW
-                        axis=2)
-
-    # compute area
-    y0 = np.sin(y_corner[:, :, 0] * np.pi / 180.) # south
-    y1 = np.sin(y_corner[:, :, 3] * np.pi / 180.) # north
-    x0 = x_corner[:, :, 0] * np.pi / 180.         # west
-    x1 = x_corner[:, :, 1] * np.pi / 180.         # east
-    grid_area = (y1 - y0) * (x1 - x0)
+    # (broadcast the 1D edges into preallocated arrays)
+    y_corner = np.empty((ny, nx, 4), order='C')
+    y_corner[:, :, 0] = lat_s[:, None] # SW
+    y_corner[:, :, 1] = lat_s[:, None] # SE
+    y_corner[:, :, 2] = lat_n[:, None] # NE
+    y_corner[:, :, 3] = lat_n[:, None] # NW
+
+    x_corner = np.empty((ny, nx, 4), order='C')
+    x_corner[:, :, 0] = lon_w[None, :] # SW
+    x_corner[:, :, 1] = lon_e[None, :] # SE
+    x_corner[:, :, 2] = lon_e[None, :] # NE
+    x_corner[:, :, 3] = lon_w[None, :] # NW
+
+    # compute area: on a regular grid, this depends only on latitude
+    y0 = np.sin(lat_s * np.pi / 180.) # south
+    y1 = np.sin(lat_n * np.pi / 180.) # north
+    grid_area = np.broadcast_to(((y1 - y0) * dx * np.pi / 180.)[:, None],
+                                (ny, nx))
     
     # sum of area should be equal to area of sphere
-    np.testing.assert_allclose(grid_area.sum(), 4.*np.pi)
+    # (true by construction, so only checked on request)
+    if check_area:
+        total_area = float(grid_area.sum())
+        if abs(total_area - 4. * np.pi) > 1e-7 * 4. * np.pi:
+            raise ValueError(f'total grid area {total_area} differs from 4*pi')
     
-    # construct mask
+    # construct mask (0/1 values only; written as int32)
     if grid_imask is None:
-        grid_imask = np.ones((ny, nx), dtype=np.int32)
+        grid_imask = np.ones((ny, nx), dtype=np.int8, order='C')
     
     # generate output dataset
-    dso = xr.Dataset()    
-    dso['grid_dims'] = xr.DataArray(np.array([nx, ny], dtype=np.int32), 
-                                    dims=('grid_rank',)) 
-    dso.grid_dims.encoding = {'dtype': np.int32}
-
-    dso['grid_center_lat'] = xr.DataArray(y_center.reshape((-1,)), 
-                                          dims=('grid_size'),
-                                          attrs={'units': 'degrees'})
-
-    dso['grid_center_lon'] = xr.DataArray(x_center.reshape((-1,)), 
-                                          dims=('grid_size'),
-                                          attrs={'units': 'degrees'})
-    
-    dso['grid_corner_lat'] = xr.DataArray(y_corner.reshape((-1, 4)), 
-                                          dims=('grid_size', 'grid_corners'), 
-                                          attrs={'units': 'degrees'})
-    dso['grid_corner_lon'] = xr.DataArray(x_corner.reshape((-1, 4)), 
-                                      dims=('grid_size', 'grid_corners'), 
-                                      attrs={'units': 'degrees'})    
-
-    dso['grid_imask'] = xr.DataArray(grid_imask.reshape((-1,)), 
-                                     dims=('grid_size'),
-                                     attrs={'units': 'unitless'})
-    dso.grid_imask.encoding = {'dtype': np.int32}
-    
-    dso['grid_area'] = xr.DataArray(grid_area.reshape((-1,)), 
-                                     dims=('grid_size'),
-                                     attrs={'units': 'radians^2',
-                                            'long_name': 'area weights'})
-    
-    # force no '_FillValue' if not specified
-    for v in dso.variables:
-        if '_FillValue' not in dso[v].encoding:
-            dso[v].encoding['_FillValue'] = None
+    dso = xr.Dataset({
+        'grid_dims': _scrip_dataarray(np.array([nx, ny], dtype=np.int32),
+                                      dims=('grid_rank',), dtype=np.int32),
+        'grid_center_lat': _scrip_dataarray(y_center.ravel(),
+                                            dims=('grid_size',),
+                                            attrs={'units': 'degrees'}),
+        'grid_center_lon': _scrip_dataarray(x_center.ravel(),
+                                            dims=('grid_size',),
+                                            attrs={'units': 'degrees'}),
+        'grid_corner_lat': _scrip_dataarray(y_corner.reshape((-1, 4)),
+                                            dims=('grid_size', 'grid_corners'),
+                                            attrs={'units': 'degrees'}),
+        'grid_corner_lon': _scrip_dataarray(x_corner.reshape((-1, 4)),
+                                            dims=('grid_size', 'grid_corners'),
+                                            attrs={'units': 'degrees'}),
+        'grid_imask': _scrip_dataarray(np.ravel(grid_imask),
+                                       dims=('grid_size',),
+                                       attrs={'units': 'unitless'},
+                                       dtype=np.int32),
+        'grid_area': _scrip_dataarray(grid_area.ravel(),
+                                      dims=('grid_size',),
+                                      attrs={'units': 'radians^2',
+                                             'long_name': 'area weights'}),
+    })
 
     dso.attrs = {'title': f'{dy} x {dx} (lat x lon) grid',
                  'created_by': 'latlon_to_scrip',
@@ -114,38 +160,43 @@ def latlon_to_scrip(nx, ny, lon0=-180., grid_imask=None, file_out=None):
     # write output file
     if file_out is not None:
         print(f'writing {file_out}')
-        dso.to_netcdf(file_out)
+        # uncompressed, contiguous variables: SCRIP files are read whole by
+        # ESMF tools, which gain nothing from compression or chunking
+        encoding = {v: {**dso[v].encoding, 'zlib': False, 'contiguous': True}
+                    for v in dso.variables}
+        dso.to_netcdf(file_out, engine='netcdf4', format='NETCDF4_CLASSIC',
+                      encoding=encoding)
         
     return dso
 
 
-def esmf_apply_weights(weights, indata, shape_in, shape_out):
+def esmf_apply_weights(weights, indata, shape_in, shape_out, backend='scipy'):
         '''
         Apply regridding weights to data.
         Parameters
         ----------
-        A : scipy sparse COO matrix
+        weights : scipy sparse matrix (CSR preferred)
         indata : numpy array of shape ``(..., n_lat, n_lon)`` or ``(..., n_y, n_x)``.
-            Should be C-ordered. Will be then tranposed to F-ordered.
+            Should be C-ordered; other layouts are copied to C order.
         shape_in, shape_out : tuple of two integers
             Input/output data shape for unflatten operation.
             For rectilinear grid, it is just ``(n_lat, n_lon)``.
+        backend : {'scipy', 'mkl', 'numba'}, optional [default='scipy']
+            If 'mkl', use the threaded ``sparse_dot_mkl`` kernel when the
+            number of extra-dimension levels exceeds `MKL_MIN_LEVELS`.
+            If 'numba', apply single-level input with CSR weights using a
+            parallel Numba kernel; this only pays off with multiple cores.
+            Do not call it from multiple threads at once: Numba's default
+            threading layer can deadlock on concurrent parallel launches.
         Returns
         -------
         outdata : numpy array of shape ``(..., shape_out[0], shape_out[1])``.
-            Extra dimensions are the same as `indata`.
-            If input data is C-ordered, output will also be C-ordered.
+            Extra dimensions are the same as `indata`; the dtype is that of
+            `weights`. Output is C-ordered.
         '''
 
 
 
-        # COO matrix is fast with F-ordered array but slow with C-array, so we
-        # take in a C-ordered and then transpose)
-        # (CSR or CRS matrix is fast with C-ordered array but slow with F-array)
-        if not indata.flags['C_CONTIGUOUS']:
-            warnings.warn("Input array is not C_CONTIGUOUS. "
-                          "Will affect performance.")
-
         # get input shape information
         shape_horiz = indata.shape[-2:]
         extra_shape = indata.shape[0:-2]
@@ -163,42 +214,113 @@ def esmf_apply_weights(weights, indata, shape_in, shape_out):
             "ny_out * nx_out should equal to weights.shape[0]"
         )
 
-        # use flattened array for dot operation
-        indata_flat = indata.reshape(-1, shape_in[0]*shape_in[1])
-        outdata_flat = weights.dot(indata_flat.T).T
-
-        # unflattened output array
+        # use flattened array for dot operation; the flattening reshape is
+        # only a view for C-ordered input, so make any copy explicit here,
+        # combined with the cast to the precision of the weights
+        # (e.g. float32 weights halve the memory traffic of the product)
+        if indata.dtype != weights.dtype or not indata.flags['C_CONTIGUOUS']:
+            indata = np.ascontiguousarray(indata, dtype=weights.dtype)
+        indata_flat = indata.reshape(-1, int(shape_in[0]) * int(shape_in[1]))
+        if indata_flat.shape[0] == 1:
+            # single level: a matrix-vector product
+            if backend == 'numba' and sps.isspmatrix_csr(weights):
+                # call the jitted kernel directly, skipping scipy's
+                # dispatch overhead
+                outdata_flat = np.empty((1, weights.shape[0]), dtype=weights.dtype)
+                _numba_csr_matvec()(weights.indptr, weights.indices,
+                                    weights.data, indata_flat[0],
+                                    outdata_flat[0])
+            else:
+                # a 1D operand takes scipy's matvec path, avoiding the
+                # transposes of the multi-vector product
+                outdata_flat = (weights @ indata_flat[0])[None, :]
+        elif backend == 'mkl' and indata_flat.shape[0] > MKL_MIN_LEVELS:
+            outdata_flat = sparse_dot_mkl.dot_product_mkl(
+                weights, indata_flat.T, dense=True
+            ).T
+        else:
+            outdata_flat = weights.dot(indata_flat.T).T
+
+        # unflattened output array: make the flat result C-ordered
+        # explicitly so that the reshape below is a view; this is free on
+        # the single-level and MKL paths, but for multiple levels
+        # weights.dot(...).T is a transposed view, so a full copy of the
+        # output is still made here, just not hidden in the reshape
+        outdata_flat = np.ascontiguousarray(outdata_flat)
         outdata = outdata_flat.reshape(
-            [*extra_shape, shape_out[0], shape_out[1]])
+            (*extra_shape, shape_out[0], shape_out[1]))
         return outdata
     
 class regridder(object):
     """simple class to enable regridding"""
     
-    def __init__(self, src_grid_file, dst_grid_file, weight_file):
+    def __init__(self, src_grid_file, dst_grid_file, weight_file,
+                 backend='scipy', dtype=np.float64):
         
+        if backend not in ['scipy', 'mkl', 'numba']:
+            raise ValueError(f'unknown backend: {backend}')
+        if backend == 'mkl' and sparse_dot_mkl is None:
+            raise ImportError("backend='mkl' requires sparse_dot_mkl")
+        if backend == 'numba':
+            try:
+                _numba_csr_matvec()
+            except ImportError:
+                raise ImportError("backend='numba' requires numba")
+        self.backend = backend
+
         # TODO: do I actually need the grid files here?
         #       shouldn't all the information be in the weight file?
         self.src_grid_file = src_grid_file
         self.dst_grid_file = dst_grid_file
         
-        with xr.open_dataset(src_grid_file) as src:
-            self.dims_src = tuple(src.grid_dims.values[::-1])
+        # read only the required variables with netCDF4 directly,
+        # bypassing xarray's decoding machinery
+        with netCDF4.Dataset(src_grid_file) as src:
+            src.set_auto_mask(False)
+            self.dims_src = tuple(int(d) for d in src.variables['grid_dims'][:][::-1])
     
-        with xr.open_dataset(dst_grid_file) as dst:
-            self.dims_dst = tuple(dst.grid_dims.values[::-1])
-            self.mask_dst = dst.grid_imask.values.reshape(self.dims_dst).T
-
-        n_dst = np.prod(self.dims_dst)
-        n_src = np.prod(self.dims_src)
+        with netCDF4.Dataset(dst_grid_file) as dst:
+            dst.set_auto_mask(False)
+            self.dims_dst = tuple(int(d) for d in dst.variables['grid_dims'][:][::-1])
+            self.mask_dst = dst.variables['grid_imask'][:].reshape(self.dims_dst).T
+        # boolean copy in the (ny, nx) orientation of the output
+        self.mask_dst_bool = self.mask_dst.T.astype(bool)
+
+        # plain Python ints (not numpy scalars) for the matrix shape
+        self.n_dst = self.dims_dst[0] * self.dims_dst[1]
+        self.n_src = self.dims_src[0] * self.dims_src[1]
         print(f'source grid dims: {self.dims_src}')
         print(f'destination grid dims: {self.dims_dst}')
 
-        with xr.open_dataset(weight_file) as mf:
-            row = mf.row.values - 1
-            col = mf.col.values - 1
-            S = mf.S.values
-        self.weights = sps.coo_matrix((S, (row, col)), shape=[n_dst, n_src])
+        with netCDF4.Dataset(weight_file) as mf:
+            mf.set_auto_mask(False)
+            row = mf.variables['row'][:] - 1
+            col = mf.variables['col'][:] - 1
+            S = mf.variables['S'][:]
+
+        # conservative weights are area fractions in [0, 1], so they can be
+        # stored in single precision if requested (dtype=np.float32)
+        S = S.astype(dtype, copy=False)
+
+        # use 32-bit indices when they suffice
+        if max(self.n_dst, self.n_src, S.size) < 2**31:
+            row = row.astype(np.int32, copy=False)
+            col = col.astype(np.int32, copy=False)
+
+        # store weights as CSR: the matrix is reused for every regrid call
+        # and CSR is faster than COO for repeated sparse-dense products;
+        # canonicalize it once here rather than on each use
+        self.weights = sps.coo_matrix(
+            (S, (row, col)), shape=[self.n_dst, self.n_src]
+        ).tocsr()
+        self.weights.sum_duplicates()
+        self.weights.eliminate_zeros()
+        self.weights.sort_indices()
+
+        # remapped field of ones (sum of weights for each destination point);
+        # used to renormalize inputs that have no missing values
+        self._row_sums = np.asarray(self.weights.sum(axis=1)).reshape(self.dims_dst)
+        self._row_sums_valid = self._row_sums > 0.0
 
     def __repr__(self):
         return (
@@ -206,20 +328,70 @@ class regridder(object):
         )
     
     def regrid_dataarray(self, da_in, renormalize=True, apply_mask=True):
-        """regrid DataArray"""
-        # Pull data, dims and coords from incoming DataArray
-        data_src = da_in.data
+        """regrid DataArray
+        
+        Dask-backed inputs are regridded lazily, chunk by chunk along the
+        non-lateral dimensions; the lateral dimensions, which must be the
+        last two, cannot be chunked. With backend='numba', chunks are
+        regridded with scipy.
+        """
+        # Pull dims and coords from incoming DataArray
+        lateral_dims = list(da_in.dims[-2:])
         non_lateral_dims = da_in.dims[:-2]
         copy_coords = {d: da_in.coords[d] for d in non_lateral_dims if d in da_in.coords}
 
+        if da_in.chunks is not None:
+            # chunks are regridded concurrently in dask's worker threads,
+            # where the parallel Numba kernel can deadlock; use scipy instead
+            backend = 'scipy' if self.backend == 'numba' else self.backend
+            data_dst = xr.apply_ufunc(
+                self._regrid_array, da_in,
+                kwargs={'renormalize': renormalize, 'backend': backend},
+                input_core_dims=[lateral_dims],
+                output_core_dims=[lateral_dims],
+                exclude_dims=set(lateral_dims),
+                dask='parallelized',
+                output_dtypes=[self.weights.dtype],
+                dask_gufunc_kwargs={
+                    'output_sizes': dict(zip(lateral_dims, self.dims_dst))
+                },
+            ).data
+        else:
+            data_dst = self._regrid_array(da_in.data, renormalize=renormalize)
+
+        # reform into xarray.DataArray
+        # (the same way for both paths, so results do not depend on chunking)
+        da_out = xr.DataArray(
+            data_dst, name=da_in.name, dims=da_in.dims, attrs=da_in.attrs, coords=copy_coords
+        )
+
+        # Apply a missing-values mask
+        if apply_mask:
+            da_out = da_out.where(self.mask_dst_bool)
+
+        return da_out
+
+    def _regrid_array(self, data_src, renormalize=True, backend=None):
+        """regrid a numpy array with lateral dimensions last"""
+        if backend is None:
+            backend = self.backend
+
         # If renormalize == True, remap a field of ones
+        # (only necessary if there are missing values; otherwise the
+        # remapped ones are the cached row sums of the weights)
+        # (the sum is NaN if any element is, and needs no full-size
+        # temporary; a NaN from inf - inf just takes the general path)
         if renormalize:
-            ones_src = np.where(np.isnan(data_src), 0.0, 1.0)
-            data_src = np.where(np.isnan(data_src), 0.0, data_src)
+            has_nan = np.isnan(np.sum(data_src))
+            if has_nan:
+                nan_mask = np.isnan(data_src)
+                ones_src = (~nan_mask).astype(self.weights.dtype)
+                data_src = np.where(nan_mask, 0.0, data_src)
 
         # remap the field
         data_dst = esmf_apply_weights(
-            self.weights, data_src, self.dims_src, self.dims_dst
+            self.weights, data_src, self.dims_src, self.dims_dst,
+            backend=backend,
         )
 
         # Renormalize to include non-missing data_src
@@ -227,23 +399,18 @@ class regridder(object):
         #       the user could specify a fraction of mapped points, 
         #       below which the value yields missing in the data_dst
         if renormalize:
-            old_err_settings = np.seterr(invalid='ignore')
-            ones_dst = esmf_apply_weights(
-                self.weights, ones_src, self.dims_src, self.dims_dst
-            )
-            ones_dst = np.where(ones_dst > 0.0, ones_dst, np.nan)
-            data_dst = data_dst / ones_dst
-            data_dst = np.where(ones_dst > 0.0, data_dst, np.nan)
-            np.seterr(**old_err_settings)
-
-        # reform into xarray.DataArray
-        da_out = xr.DataArray(
-            data_dst, name=da_in.name, dims=da_in.dims, attrs=da_in.attrs, coords=copy_coords
-        )
-
-        # Apply a missing-values mask
-        if apply_mask:
-            da_out = da_out.where(self.mask_dst.T)
-
-        return da_out
-    
\ No newline at end of file
+            if has_nan:
+                ones_dst = esmf_apply_weights(
+                    self.weights, ones_src, self.dims_src, self.dims_dst,
+                    backend=backend,
+                )
+                valid = ones_dst > 0.0
+            else:
+                # (ny, nx) arrays, broadcast against the extra dimensions
+                ones_dst = self._row_sums
+                valid = self._row_sums_valid
+            # divide in place where any source points were mapped
+            np.divide(data_dst, ones_dst, out=data_dst, where=valid)
+            np.copyto(data_dst, np.nan, where=~valid)
+
+        return data_dst